@@ -0,0 +1,148 @@
+# coding: utf-8
+import os
+import json
+import time
+import errno
+import hashlib
+import logging
+import itertools
+import tempfile
+
+
+class DiskCache(object):
+    """Дисковый кеш ответов списочных методов API (``tags/``,
+    ``subscribers/``, ``unsubscribed/``).
+
+    Записи адресуются ключом -- любым значением, сериализуемым в JSON
+    (клиент использует адрес запроса, хеш ключа доступа и параметры).
+    Каждая страница хранится в отдельном файле вместе с заголовками
+    ``ETag`` и ``Last-Modified``, по которым клиент делает условные
+    запросы. Время изменения файла -- время последней проверки записи
+    на сервере: по нему определяется свежесть записи, и записи, дольше
+    всех не проверявшиеся, вытесняются первыми, когда суммарный размер
+    кеша превышает `max_size`.
+
+    :param path: каталог для файлов кеша
+    :param max_size: максимальный суммарный размер файлов в байтах
+    :param max_age: сколько секунд после проверки запись считается свежей
+                    и может использоваться без запроса к API
+    """
+
+    def __init__(self, path, max_size=64 * 1024 * 1024, max_age=60):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._size = sum(size for _, _, size in self._files())
+        # Порядок записи и проверки файлов в этом процессе; различает
+        # файлы с одинаковым временем изменения
+        self._counter = itertools.count(1)
+        self._order = {}
+        self._logger = logging.getLogger(__name__)
+
+    def _files(self):
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            file_path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            yield file_path, stat.st_mtime, stat.st_size
+
+    def _file_path(self, key):
+        key = json.dumps(key, sort_keys=True)
+        return os.path.join(self.path,
+                            hashlib.sha1(key).hexdigest() + '.json')
+
+    def _touched(self, file_path):
+        self._order[file_path] = next(self._counter)
+
+    def get(self, key):
+        """Возвращает запись кеша или ``None``.
+
+        Запись -- словарь с ключами ``data``, ``etag``, ``last_modified``
+        и ``validated_at``.
+        """
+        file_path = self._file_path(key)
+        try:
+            with open(file_path) as f:
+                entry = json.load(f)
+            entry['validated_at'] = os.path.getmtime(file_path)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry['validated_at'] < self.max_age
+
+    def conditional_headers(self, entry):
+        """Возвращает заголовки условного запроса для записи `entry`."""
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def set(self, key, data, response):
+        """Сохраняет разобранный ответ `response` на запрос страницы."""
+        file_path = self._file_path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'data': data,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }, f)
+        size = os.path.getsize(tmp_path)
+        try:
+            size -= os.path.getsize(file_path)
+        except OSError:
+            pass
+        os.rename(tmp_path, file_path)
+        self._touched(file_path)
+        self._size += size
+        if self._size > self.max_size:
+            self._evict()
+
+    def revalidate(self, key):
+        """Отмечает запись как проверенную (сервер ответил 304)."""
+        file_path = self._file_path(key)
+        try:
+            os.utime(file_path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            self._touched(file_path)
+
+    def _evict(self):
+        # Файлы, не тронутые этим процессом, при равном времени
+        # изменения вытесняются первыми
+        files = sorted(self._files(), key=lambda item: (
+            item[1], self._order.get(item[0], 0)))
+        size = sum(size for _, _, size in files)
+        for file_path, _, file_size in files:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                continue
+            self._logger.debug('Evicted %s from cache', file_path)
+            self._order.pop(file_path, None)
+            size -= file_size
+        self._size = size
+
+    def clear(self):
+        for file_path, _, _ in list(self._files()):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        self._order.clear()
+        self._size = 0
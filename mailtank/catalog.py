@@ -0,0 +1,148 @@
+# coding: utf-8
+import time
+import bisect
+import logging
+import threading
+
+from .models import Tag
+
+
+class TagCatalog(object):
+    """Локальный каталог тегов проекта.
+
+    Загружает полный список тегов один раз и отвечает на запросы
+    по префиксу имени тега (например, ``rss:lala:``) без обращения к API.
+    По истечении `ttl` секунд каталог обновляется в фоновом потоке,
+    а до окончания обновления запросы обслуживаются по старым данным.
+
+    :param client: экземпляр :class:`mailtank.Mailtank`
+    :param ttl: время жизни загруженного списка в секундах
+    """
+
+    def __init__(self, client, ttl=300):
+        self._client = client
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._names = None
+        self._loaded_at = None
+        self._refreshing = False
+        # Теги, добавленные через :meth:`add` во время фонового обновления
+        self._added_during_refresh = set()
+        self._logger = logging.getLogger(__name__)
+
+    def _fetch_names(self):
+        names = set()
+        for columns in self._client.get_tags().iter_columns(['name']):
+            names.update(columns['name'])
+        return sorted(names)
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._names is None:
+                self._refreshing = True
+            elif (not self._refreshing and
+                  time.time() - self._loaded_at >= self._ttl):
+                self._refreshing = True
+                thread = threading.Thread(target=self._refresh)
+                thread.daemon = True
+                thread.start()
+                return
+            else:
+                return
+        self._refresh()
+
+    def _refresh(self):
+        try:
+            names = self._fetch_names()
+        except Exception:
+            with self._lock:
+                self._refreshing = False
+                self._added_during_refresh.clear()
+                if self._names is not None:
+                    # Следующая попытка -- не раньше чем через `ttl`,
+                    # а до тех пор обслуживаем старыми данными
+                    self._loaded_at = time.time()
+            self._logger.exception('Failed to refresh tag catalog')
+            if self._names is None:
+                raise
+            return
+
+        with self._lock:
+            if self._added_during_refresh:
+                names = sorted(set(names) | self._added_during_refresh)
+                self._added_during_refresh.clear()
+            self._names = names
+            self._loaded_at = time.time()
+            self._refreshing = False
+
+    def refresh(self):
+        """Синхронно перезагружает список тегов."""
+        with self._lock:
+            self._refreshing = True
+        self._refresh()
+
+    def add(self, *tags):
+        """Добавляет теги в каталог, не обращаясь к API.
+
+        Вызывается клиентом для тегов, которые создаются неявно
+        (при создании подписчика или переназначении тега).
+        """
+        with self._lock:
+            if self._refreshing:
+                self._added_during_refresh.update(tags)
+            if self._names is None:
+                return
+            names = self._names
+            for tag in tags:
+                i = bisect.bisect_left(names, tag)
+                if i == len(names) or names[i] != tag:
+                    if names is self._names:
+                        # Копируем список, чтобы не менять его под
+                        # читателями, уже получившими ссылку
+                        names = list(names)
+                    names.insert(i, tag)
+            self._names = names
+
+    def get_tag_names(self, prefix=None, start=0, end=None):
+        """Возвращает отсортированный список имён тегов, начинающихся
+        с `prefix`.
+
+        В отличие от параметра `mask` у :meth:`mailtank.Mailtank.get_tags`,
+        `prefix` всегда сравнивается с началом имени тега.
+
+        :param prefix: префикс имени тега; если не задан, возвращаются
+                       все теги
+        :param start: с которой записи
+        :param end: по которую
+        """
+        self._ensure_loaded()
+        names = self._names
+        if not prefix:
+            return names[start:end]
+
+        # Теги с общим префиксом идут в отсортированном списке подряд
+        i = bisect.bisect_left(names, prefix) + start
+        stop = len(names) if end is None else min(len(names), i - start + end)
+        rv = []
+        while i < stop and names[i].startswith(prefix):
+            rv.append(names[i])
+            i += 1
+        return rv
+
+    def get_tags(self, prefix=None, start=0, end=None):
+        """Возвращает теги, имена которых начинаются с `prefix`.
+
+        :rtype: список :class:`mailtank.models.Tag`
+        """
+        return [Tag({'name': name}, client=self._client)
+                for name in self.get_tag_names(prefix, start=start, end=end)]
+
+    def __contains__(self, tag):
+        self._ensure_loaded()
+        names = self._names
+        i = bisect.bisect_left(names, tag)
+        return i < len(names) and names[i] == tag
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._names)
@@ -1,12 +1,16 @@
 # coding: utf-8
 import sys
 import json
+import time
+import hashlib
 import logging
 from urlparse import urljoin
 
 import requests
 
 from .models import Tag, Mailing, Layout, Project, Subscriber, Unsubscribe
+from .catalog import TagCatalog
+from .reconcile import SubscriberReconciler
 from .exceptions import MailtankError
 
 
@@ -14,17 +18,33 @@ ident = lambda x: x
 
 
 class MailtankIterator(object):
-    def __init__(self, fetch_page, wrapper=ident, start=0, end=None):
+    def __init__(self, fetch_page, wrapper=ident, start=0, end=None,
+                 profiler=None, fetch_total=None):
         self._fetch_page = fetch_page
+        self._fetch_total = fetch_total
         self._start = start
         self._end = end
         self._wrapper = wrapper
+        self._profiler = profiler
 
     def get_total_count(self):
+        if self._fetch_total is not None:
+            return self._fetch_total()
         return self._fetch_page(0)['total']
 
-    def __iter__(self):
-        first_page_data = self._fetch_page(0)
+    def _fetch(self, n):
+        if self._profiler is None:
+            return self._fetch_page(n)
+        stats = self._profiler.begin_page(n)
+        started = time.time()
+        page_data = self._fetch_page(n)
+        if stats.decode_time is None:
+            # `fetch_page` не сообщил замеры через `record_response`
+            stats.fetch_time = time.time() - started
+        return page_data
+
+    def _pages(self):
+        first_page_data = self._fetch(0)
         pages_total = first_page_data['pages_total']
         objects_per_page = len(first_page_data['objects'])
         if objects_per_page == 0:
@@ -42,20 +62,94 @@ class MailtankIterator(object):
         current_page = start_page
 
         while current_page < pages_total and limit > 0:
-            yielded = 0
-            page_data = self._fetch_page(current_page)
-            for obj in page_data['objects'][to_skip:to_skip+limit]:
-                yield self._wrapper(obj)
-                yielded += 1
+            page_data = self._fetch(current_page)
+            objects = page_data['objects']
+            if to_skip or len(objects) - to_skip > limit:
+                objects = objects[to_skip:to_skip+limit]
+            if objects:
+                yield objects
             current_page += 1
-            limit -= yielded
+            limit -= len(objects)
             to_skip = 0
 
+    def _profiled_pages(self, transform):
+        profiler = self._profiler
+        try:
+            for objects in self._pages():
+                stats = profiler.current
+                started = time.time()
+                rv = transform(objects)
+                stats.wrap_time += time.time() - started
+                stats.objects += len(objects)
+                started = time.time()
+                yield rv
+                stats.consumer_time += time.time() - started
+        finally:
+            profiler.finish()
+
+    def _profiled_objects(self):
+        profiler = self._profiler
+        wrapper = self._wrapper
+        try:
+            for objects in self._pages():
+                stats = profiler.current
+                for obj in objects:
+                    started = time.time()
+                    wrapped = wrapper(obj)
+                    wrapped_at = time.time()
+                    stats.wrap_time += wrapped_at - started
+                    stats.objects += 1
+                    yield wrapped
+                    stats.consumer_time += time.time() - wrapped_at
+        finally:
+            profiler.finish()
+
+    def iter_pages(self):
+        """Итерирует по страницам, возвращая списки объектов в том виде,
+        в котором их вернул API, без оборачивания в модели.
+
+        Учитывает `start` и `end`, поэтому первая и последняя страницы
+        могут быть обрезаны.
+        """
+        if self._profiler is None:
+            return self._pages()
+        return self._profiled_pages(ident)
+
+    def iter_columns(self, fields):
+        """Итерирует по страницам, возвращая для каждой словарь, в котором
+        каждому полю из `fields` соответствует список его значений.
+
+        :param fields: список имён полей
+        """
+        def columns(objects):
+            return dict((field, [obj.get(field) for obj in objects])
+                        for field in fields)
+        if self._profiler is None:
+            return (columns(objects) for objects in self._pages())
+        return self._profiled_pages(columns)
+
+    def __iter__(self):
+        if self._profiler is None:
+            wrapper = self._wrapper
+            return (wrapper(obj) for objects in self._pages() for obj in objects)
+        return self._profiled_objects()
+
 
 class Mailtank(object):
-    def __init__(self, api_url, api_key):
+    """Клиент Mailtank API.
+
+    :param api_url: адрес API
+    :param api_key: ключ доступа к API
+    :param cache: дисковый кеш страниц списочных методов
+    :type cache: :class:`mailtank.cache.DiskCache`
+    :param tag_catalog_ttl: время жизни списка тегов в каталоге
+                            (см. :meth:`get_tag_catalog`) в секундах
+    """
+
+    def __init__(self, api_url, api_key, cache=None, tag_catalog_ttl=300):
         self._api_url = api_url
         self._api_key = api_key
+        self._cache = cache
         self._session = requests.session()
         self._session.headers.update({
             'Content-Type': 'application/json',
@@ -63,6 +157,8 @@ class Mailtank(object):
             'X-Auth-Token': self._api_key,
         })
         self._logger = logging.getLogger(__name__)
+        self._tag_catalog_ttl = tag_catalog_ttl
+        self._tag_catalog = None
 
     def _check_response(self, response):
         if not 200 <= response.status_code < 400:
@@ -96,9 +192,57 @@ class Mailtank(object):
         self._logger.debug('DELETE %s with %s', url, kwargs)
         return self._session.delete(url, **kwargs)
 
-    def _get_endpoint(self, endpoint, **kwargs):
+    def _fetch_json(self, fetch, decode, profiler=None):
+        """Выполняет запрос `fetch` и разбирает ответ функцией `decode`,
+        сообщая `profiler` время запроса и разбора."""
+        if profiler is None:
+            return decode(fetch())
+
+        started = time.time()
+        response = fetch()
+        fetched = time.time()
+        data = decode(response)
+        profiler.record_response(fetched - started, time.time() - fetched,
+                                 len(response.content))
+        return data
+
+    def _get_endpoint(self, endpoint, profiler=None, **kwargs):
+        url = urljoin(self._api_url, endpoint)
+        return self._fetch_json(lambda: self._get(url, **kwargs), self._json,
+                                profiler=profiler)
+
+    def _get_list_page(self, endpoint, params, profiler=None,
+                       allow_fresh=False):
+        """Запрашивает страницу списка, пользуясь дисковым кешем,
+        если он задан.
+
+        :param allow_fresh: вернуть свежую запись кеша, не обращаясь к API
+        """
+        cache = self._cache
+        if cache is None:
+            return self._get_endpoint(endpoint, profiler=profiler,
+                                      params=params)
+
         url = urljoin(self._api_url, endpoint)
-        return self._json(self._get(url, **kwargs))
+        # Ключ доступа определяет проект, поэтому входит в ключ кеша
+        key = [url, hashlib.sha1(self._api_key.encode('utf-8')).hexdigest(), params]
+        entry = cache.get(key)
+        if entry is not None and allow_fresh and cache.is_fresh(entry):
+            return entry['data']
+
+        def fetch():
+            return self._get(url, params=params,
+                             headers=cache.conditional_headers(entry))
+
+        def decode(response):
+            if entry is not None and response.status_code == 304:
+                cache.revalidate(key)
+                return entry['data']
+            data = self._json(response)
+            cache.set(key, data, response)
+            return data
+
+        return self._fetch_json(fetch, decode, profiler=profiler)
 
     def _post_endpoint(self, endpoint, data, **kwargs):
         url = urljoin(self._api_url, endpoint)
@@ -116,26 +260,45 @@ class Mailtank(object):
         url = urljoin(self._api_url, endpoint)
         return self._check_response(self._delete(url, **kwargs))
 
-    def get_tags(self, mask=None, start=0, end=None):
-        def fetch_page(n):
-            return self._get_endpoint(
-                'tags/', params={
+    def get_tags(self, mask=None, start=0, end=None, profiler=None):
+        def fetch_page(n, allow_fresh=False, profiler=profiler):
+            return self._get_list_page(
+                'tags/', {
                     'mask': mask,
                     # Mailtank API считает страницы с единицы
                     'page': n + 1,
-                })
+                }, profiler=profiler, allow_fresh=allow_fresh)
+        fetch_total = lambda: fetch_page(
+            0, allow_fresh=True, profiler=None)['total']
         wrapper = lambda *args, **kwargs: Tag(*args, client=self, **kwargs)
-        return MailtankIterator(fetch_page, wrapper, start=start, end=end)
+        return MailtankIterator(fetch_page, wrapper, start=start, end=end,
+                                profiler=profiler, fetch_total=fetch_total)
 
-    def get_subscribers(self, query=None, start=0, end=None):
-        def fetch_page(n):
-            return self._get_endpoint(
-                'subscribers/', params={
+    def get_tag_catalog(self):
+        """Возвращает локальный каталог тегов проекта.
+
+        Каталог создаётся при первом вызове и далее переиспользуется;
+        теги, неявно создаваемые через :meth:`create_subscriber`
+        и :meth:`reassign_tag`, добавляются в него сразу.
+
+        :rtype: :class:`mailtank.catalog.TagCatalog`
+        """
+        if self._tag_catalog is None:
+            self._tag_catalog = TagCatalog(self, ttl=self._tag_catalog_ttl)
+        return self._tag_catalog
+
+    def get_subscribers(self, query=None, start=0, end=None, profiler=None):
+        def fetch_page(n, allow_fresh=False, profiler=profiler):
+            return self._get_list_page(
+                'subscribers/', {
                     'query': query,
                     'page': n + 1,
-                })
+                }, profiler=profiler, allow_fresh=allow_fresh)
+        fetch_total = lambda: fetch_page(
+            0, allow_fresh=True, profiler=None)['total']
         wrapper = lambda *args, **kwargs: Subscriber(*args, client=self, **kwargs)
-        return MailtankIterator(fetch_page, wrapper, start=start, end=end)
+        return MailtankIterator(fetch_page, wrapper, start=start, end=end,
+                                profiler=profiler, fetch_total=fetch_total)
 
     def get_project(self):
         """Возвращает текущий проект.
@@ -172,6 +335,8 @@ class Mailtank(object):
             data['properties'] = properties
 
         response = self._post_endpoint('subscribers/', data)
+        if tags and self._tag_catalog is not None:
+            self._tag_catalog.add(*tags)
         return Subscriber(response, client=self)
 
     def get_subscriber(self, id):
@@ -190,11 +355,35 @@ class Mailtank(object):
             data['properties'] = properties
 
         self._put_endpoint('subscribers/{0}'.format(id), data)
+        if tags and self._tag_catalog is not None:
+            self._tag_catalog.add(*tags)
 
     def delete_subscriber(self, id):
         """Удаляет подписчика."""
         self._delete_endpoint('subscribers/{0}'.format(id))
 
+    def reconcile_subscribers(self, desired, dry_run=False, concurrency=4,
+                              reassign_threshold=100):
+        """Приводит подписчиков проекта к желаемому состоянию.
+
+        Создаёт, обновляет и удаляет подписчиков и переназначает теги
+        так, чтобы они совпали с `desired`.
+
+        :param desired: итерируемый объект со словарями с полями ``id``,
+                        ``email``, ``tags``, ``properties``; обходится
+                        один раз
+        :param dry_run: только построить план, ничего не меняя
+        :param concurrency: сколько запросов выполнять одновременно
+        :param reassign_threshold: см. :class:`mailtank.reconcile.SubscriberReconciler`;
+                                   ``None`` отключает переназначение тегов
+
+        :rtype: :class:`mailtank.reconcile.ReconcilePlan`
+        """
+        reconciler = SubscriberReconciler(
+            self, concurrency=concurrency,
+            reassign_threshold=reassign_threshold)
+        return reconciler.reconcile(desired, dry_run=dry_run)
+
     def reassign_tag(self, tag, subscribers):
         """Переназначает тег `tag` подписчикам, указанным в `subscribers`.
 
@@ -208,6 +397,8 @@ class Mailtank(object):
                 'tag': tag,
             },
         })
+        if self._tag_catalog is not None:
+            self._tag_catalog.add(tag)
 
     def create_mailing(self, layout_id, context, target, attachments=None):
         """Создает и выполняет рассылку.
@@ -279,7 +470,7 @@ class Mailtank(object):
         """Удаляет шаблон."""
         self._delete_endpoint('layouts/{0}'.format(id))
 
-    def get_unsubscribes(self, since=None, start=0, end=None):
+    def get_unsubscribes(self, since=None, start=0, end=None, profiler=None):
         """Возвращает итератор по отпискам.
 
         :param since: время, начиная с которого перечислять отписки
@@ -290,11 +481,19 @@ class Mailtank(object):
 
         :param end: по которую
         :type end: int
+
+        :param profiler: объект для сбора замеров сканирования
+        :type profiler: :class:`mailtank.profiling.ScanProfile`
         """
-        def fetch_page(n):
+        def fetch_page(n, allow_fresh=False, profiler=profiler):
             params = {'page': n + 1}
             if since is not None:
                 params['since'] = since.isoformat()
-            return self._get_endpoint('unsubscribed/', params=params)
+            return self._get_list_page('unsubscribed/', params,
+                                       profiler=profiler,
+                                       allow_fresh=allow_fresh)
+        fetch_total = lambda: fetch_page(
+            0, allow_fresh=True, profiler=None)['total']
         wrapper = lambda *args, **kwargs: Unsubscribe(*args, client=self, **kwargs)
-        return MailtankIterator(fetch_page, wrapper, start=start, end=end)
+        return MailtankIterator(fetch_page, wrapper, start=start, end=end,
+                                profiler=profiler, fetch_total=fetch_total)
@@ -0,0 +1,129 @@
+# coding: utf-8
+import sys
+import logging
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def _max_rss():
+    """Возвращает пиковый размер резидентной памяти процесса в байтах."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux сообщает размер в килобайтах, macOS -- в байтах
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def log_exporter(profile):
+    """Экспортёр по умолчанию: пишет сводку сканирования в лог."""
+    logger.info('Scan profile: %s', profile.summary())
+
+
+class PageStats(object):
+    """Замеры по одной запрошенной странице.
+
+    Время указывается в секундах, память -- в байтах.
+    """
+
+    fields = ('page', 'fetch_time', 'decode_time', 'wrap_time',
+              'consumer_time', 'bytes_received', 'objects', 'memory_peak')
+
+    def __init__(self, page):
+        #: Номер страницы (с нуля)
+        self.page = page
+        #: Время запроса, включая получение тела ответа
+        self.fetch_time = 0.0
+        #: Время разбора JSON; ``None``, если `fetch_page` не сообщает его
+        self.decode_time = None
+        #: Время оборачивания объектов в модели
+        self.wrap_time = 0.0
+        #: Время, проведённое в коде потребителя между выдачами
+        self.consumer_time = 0.0
+        #: Размер тела ответа; ``None``, если `fetch_page` не сообщает его
+        self.bytes_received = None
+        #: Количество выданных объектов
+        self.objects = 0
+        #: На сколько страница подняла пиковый размер резидентной памяти
+        #: процесса (``ru_maxrss``). Ноль, если пик был достигнут раньше
+        self.memory_peak = None
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+    def __repr__(self):
+        return '<PageStats {0}>'.format(self.to_dict())
+
+
+class ScanProfile(object):
+    """Собирает постраничные замеры сканирования
+    :class:`mailtank.client.MailtankIterator`.
+
+    Передаётся в ``get_tags``, ``get_subscribers`` и ``get_unsubscribes``
+    параметром `profiler`. По окончании сканирования (в том числе
+    досрочном) вызывает `exporter` с самим собой.
+
+    :param exporter: функция, принимающая :class:`ScanProfile`
+    :param trace_memory: замерять прирост пиковой памяти процесса
+                         по :func:`resource.getrusage`; недоступно
+                         в Windows
+    """
+
+    def __init__(self, exporter=log_exporter, trace_memory=False):
+        if trace_memory and resource is None:
+            raise RuntimeError('trace_memory requires the resource module')
+        self._exporter = exporter
+        self._trace_memory = trace_memory
+        self._memory_base = None
+        #: Список :class:`PageStats` в порядке запросов
+        self.pages = []
+        #: :class:`PageStats` страницы, обрабатываемой в данный момент
+        self.current = None
+
+    def begin_page(self, page):
+        self._end_page()
+        if self._trace_memory:
+            self._memory_base = _max_rss()
+        self.current = PageStats(page)
+        self.pages.append(self.current)
+        return self.current
+
+    def _end_page(self):
+        if self.current is not None and self._trace_memory:
+            self.current.memory_peak = _max_rss() - self._memory_base
+        self.current = None
+
+    def record_response(self, fetch_time, decode_time, bytes_received):
+        """Вызывается клиентом после получения и разбора ответа API."""
+        if self.current is not None:
+            self.current.fetch_time = fetch_time
+            self.current.decode_time = decode_time
+            self.current.bytes_received = bytes_received
+
+    def finish(self):
+        self._end_page()
+        if self._exporter is not None:
+            self._exporter(self)
+
+    def summary(self):
+        """Возвращает словарь с суммарными замерами по всем страницам."""
+        def total(field):
+            values = [getattr(stats, field) for stats in self.pages]
+            values = [value for value in values if value is not None]
+            return sum(values) if values else None
+
+        peaks = [stats.memory_peak for stats in self.pages
+                 if stats.memory_peak is not None]
+        return {
+            'pages': len(self.pages),
+            'objects': total('objects'),
+            'fetch_time': total('fetch_time'),
+            'decode_time': total('decode_time'),
+            'wrap_time': total('wrap_time'),
+            'consumer_time': total('consumer_time'),
+            'bytes_received': total('bytes_received'),
+            'memory_peak': max(peaks) if peaks else None,
+        }
@@ -0,0 +1,233 @@
+# coding: utf-8
+import json
+import hashlib
+import logging
+import tempfile
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+from .exceptions import MailtankError
+
+
+def _normalize(record):
+    if hasattr(record, 'to_dict'):
+        record = record.to_dict()
+    if record.get('id') is None:
+        raise ValueError('Subscriber record must have an id: {0!r}'.format(record))
+    return {
+        'id': record['id'],
+        'email': record.get('email'),
+        'tags': sorted(set(record.get('tags') or ())),
+        'properties': record.get('properties') or {},
+    }
+
+
+def _read_spilled(spill):
+    spill.seek(0)
+    for line in spill:
+        yield json.loads(line)
+
+
+def _digest(value):
+    return hashlib.md5(json.dumps(value, sort_keys=True)).digest()
+
+
+def _digests(record):
+    """Возвращает пару хешей: email и свойств, а также тегов."""
+    return (_digest([record['email'], record['properties']]),
+            _digest(record['tags']))
+
+
+class ReconcilePlan(object):
+    """Набор операций, приводящих подписчиков Mailtank к желаемому
+    состоянию."""
+
+    def __init__(self):
+        #: Подписчики, которых нужно создать
+        self.creates = []
+        #: Аргументы :meth:`mailtank.Mailtank.update_subscriber`
+        self.updates = []
+        #: Пары (тег, список идентификаторов) для
+        #: :meth:`mailtank.Mailtank.reassign_tag`
+        self.reassigns = []
+        #: Идентификаторы подписчиков, которых нужно удалить
+        self.deletes = []
+        #: Пары (операция, :class:`mailtank.MailtankError`) для операций,
+        #: которые не удалось выполнить
+        self.errors = []
+
+    def report(self):
+        return {
+            'create': len(self.creates),
+            'update': len(self.updates),
+            'reassign_tag': len(self.reassigns),
+            'delete': len(self.deletes),
+            'errors': len(self.errors),
+        }
+
+    def __len__(self):
+        return (len(self.creates) + len(self.updates) +
+                len(self.reassigns) + len(self.deletes))
+
+    def __repr__(self):
+        return '<ReconcilePlan {0}>'.format(self.report())
+
+
+class SubscriberReconciler(object):
+    """Сравнивает желаемый список подписчиков с текущим состоянием
+    Mailtank и выполняет минимальный набор изменений.
+
+    Желаемые записи читаются один раз и сбрасываются во временный файл,
+    а с удалёнными сравниваются по хешам полей, поэтому в памяти
+    держатся только идентификаторы с хешами и сами изменения.
+    Удалённые подписчики читаются постранично.
+
+    Исключение -- переназначаемые теги: запрос
+    :meth:`mailtank.Mailtank.reassign_tag` должен перечислить всех
+    подписчиков с тегом, поэтому память и размер запроса растут с числом
+    его обладателей, а не с числом изменений. Если это неприемлемо,
+    переназначение отключается с помощью ``reassign_threshold=None``.
+
+    :param client: экземпляр :class:`mailtank.Mailtank`
+    :param concurrency: сколько запросов выполнять одновременно
+    :param reassign_threshold: если тег добавляется или снимается
+                               хотя бы у стольких подписчиков, он
+                               переназначается одним запросом
+                               :meth:`mailtank.Mailtank.reassign_tag`
+                               вместо обновления каждого подписчика;
+                               ``None`` -- всегда обновлять подписчиков
+    """
+
+    def __init__(self, client, concurrency=4, reassign_threshold=100):
+        self._client = client
+        self._concurrency = concurrency
+        self._reassign_threshold = reassign_threshold
+        self._logger = logging.getLogger(__name__)
+
+    def plan(self, desired):
+        """Строит :class:`ReconcilePlan`, ничего не меняя в Mailtank.
+
+        :param desired: итерируемый объект (например, генератор или
+                        курсор БД) со словарями или
+                        :class:`mailtank.models.Subscriber` с полями
+                        ``id``, ``email``, ``tags``, ``properties``.
+                        Обходится один раз.
+        """
+        spill = tempfile.TemporaryFile('w+')
+        try:
+            return self._plan(desired, spill)
+        finally:
+            spill.close()
+
+    def _plan(self, desired, spill):
+        plan = ReconcilePlan()
+
+        # Идентификаторы желаемых подписчиков, ещё не найденные в Mailtank
+        missing = {}
+        for record in desired:
+            record = _normalize(record)
+            if record['id'] in missing:
+                raise ValueError(
+                    'Duplicate subscriber id: {0!r}'.format(record['id']))
+            missing[record['id']] = _digests(record)
+            spill.write(json.dumps(record) + '\n')
+
+        changed = set()
+        remote_tags = {}
+        for objects in self._client.get_subscribers().iter_pages():
+            for obj in objects:
+                remote = _normalize(obj)
+                digests = missing.pop(remote['id'], None)
+                if digests is None:
+                    plan.deletes.append(remote['id'])
+                    continue
+                remote_digests = _digests(remote)
+                if digests[0] != remote_digests[0]:
+                    changed.add(remote['id'])
+                elif digests[1] != remote_digests[1]:
+                    remote_tags[remote['id']] = set(remote['tags'])
+
+        tag_changes = defaultdict(int)
+        tag_deltas = {}
+        for record in _read_spilled(spill):
+            id = record['id']
+            if id in missing:
+                plan.creates.append(record)
+            elif id in changed:
+                plan.updates.append(record)
+            elif id in remote_tags:
+                delta = remote_tags[id].symmetric_difference(record['tags'])
+                for tag in delta:
+                    tag_changes[tag] += 1
+                tag_deltas[id] = (record['tags'], delta)
+
+        threshold = self._reassign_threshold
+        reassigned = set(tag for tag, count in tag_changes.iteritems()
+                         if threshold is not None and count >= threshold)
+        for id, (tags, delta) in tag_deltas.iteritems():
+            if not delta <= reassigned:
+                plan.updates.append({'id': id, 'tags': tags})
+
+        if reassigned:
+            members = dict((tag, []) for tag in reassigned)
+            for record in _read_spilled(spill):
+                for tag in reassigned.intersection(record['tags']):
+                    members[tag].append(record['id'])
+            plan.reassigns = sorted(members.iteritems())
+
+        return plan
+
+    def _run(self, pool, func, operations, plan):
+        def call(operation):
+            try:
+                func(operation)
+            except MailtankError as e:
+                return operation, e
+        for error in pool.map(call, operations):
+            if error is not None:
+                self._logger.warning('Failed to apply %r: %s', *error)
+                plan.errors.append(error)
+
+    def apply(self, plan):
+        """Выполняет операции из `plan`.
+
+        Сначала удаляются лишние подписчики, затем создаются
+        и обновляются остальные, в конце переназначаются теги.
+        Ошибки API не прерывают выполнение и сохраняются
+        в :attr:`ReconcilePlan.errors`.
+        """
+        client = self._client
+
+        def create(record):
+            client.create_subscriber(record['email'], id=record['id'],
+                                     tags=record['tags'],
+                                     properties=record['properties'])
+
+        def update(kwargs):
+            client.update_subscriber(**kwargs)
+
+        pool = ThreadPool(self._concurrency)
+        try:
+            self._run(pool, client.delete_subscriber, plan.deletes, plan)
+            self._run(pool, create, plan.creates, plan)
+            self._run(pool, update, plan.updates, plan)
+            self._run(pool, lambda args: client.reassign_tag(*args),
+                      plan.reassigns, plan)
+        finally:
+            pool.close()
+            pool.join()
+
+        self._logger.info('Reconciled subscribers: %s', plan.report())
+        return plan
+
+    def reconcile(self, desired, dry_run=False):
+        """Строит план и, если не задан `dry_run`, выполняет его.
+
+        :rtype: :class:`ReconcilePlan`
+        """
+        plan = self.plan(desired)
+        if dry_run:
+            self._logger.info('Subscribers reconciliation plan: %s',
+                              plan.report())
+            return plan
+        return self.apply(plan)
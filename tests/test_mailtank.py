@@ -1,11 +1,20 @@
+# coding: utf-8
+import os
+import copy
 import json
+import time
 import pytest
+import shutil
+import tempfile
+import threading
 import datetime as dt
 
 import furl
 import httpretty
 
 import mailtank
+from mailtank.cache import DiskCache
+from mailtank.profiling import ScanProfile, resource
 
 
 PAGES_DATA = [{
@@ -136,6 +145,402 @@ class TestMailtankIterator(object):
         })
         assert not list(it)
 
+    def test_iter_pages(self):
+        it = mailtank.client.MailtankIterator(lambda n: PAGES_DATA[n],
+                                              start=8, end=22)
+        pages = list(it.iter_pages())
+
+        assert [len(objects) for objects in pages] == [2, 10, 2]
+        assert pages[0][0] == {'name': 'tag_23758'}
+        assert pages[-1][-1] == {'name': 'tag_22437'}
+
+    def test_iter_columns(self):
+        it = mailtank.client.MailtankIterator(lambda n: SUBSCRIBERS_DATA[n])
+        columns = list(it.iter_columns(['id', 'email']))
+
+        assert columns == [{
+            'id': ['c9a454f096', '2eda62b980'],
+            'email': ['anthony.romanovich@gmail.com', 'rmnvch@yandex.ru'],
+        }]
+
+    def test_profiler(self):
+        exported = []
+        profiler = ScanProfile(exporter=exported.append)
+        it = mailtank.client.MailtankIterator(lambda n: PAGES_DATA[n],
+                                              start=8, end=22,
+                                              profiler=profiler)
+
+        assert len(list(it)) == 14
+        assert exported == [profiler]
+        # Первая страница запрашивается дважды
+        assert [stats.page for stats in profiler.pages] == [0, 0, 1, 2]
+        assert [stats.objects for stats in profiler.pages] == [0, 2, 10, 2]
+
+        summary = profiler.summary()
+        assert summary['pages'] == 4
+        assert summary['objects'] == 14
+        assert summary['decode_time'] is None
+        assert summary['wrap_time'] >= 0
+
+    def test_profiler_total_count(self):
+        exported = []
+        profiler = ScanProfile(exporter=exported.append)
+        it = mailtank.client.MailtankIterator(
+            lambda n: UNSUBSCRIBES_DATA[n], profiler=profiler)
+
+        assert it.get_total_count() == 4
+        assert profiler.pages == []
+        assert exported == []
+
+    @pytest.mark.skipif(resource is None,
+                        reason='resource module is not available')
+    def test_profiler_memory(self):
+        size = 128 * 2 ** 20
+
+        def wrapper(obj):
+            if obj['name'] == 'tag_17499':
+                return 'x' * size
+            return obj
+
+        profiler = ScanProfile(exporter=None, trace_memory=True)
+        it = mailtank.client.MailtankIterator(
+            lambda n: PAGES_DATA[n], wrapper=wrapper, profiler=profiler)
+
+        for _ in it:
+            pass
+
+        # Память выделяется только при обработке второй страницы
+        assert [stats.page for stats in profiler.pages] == [0, 0, 1, 2]
+        assert profiler.pages[2].memory_peak >= size / 2
+        assert profiler.summary()['memory_peak'] == profiler.pages[2].memory_peak
+
+    def test_profiler_partial_scan(self):
+        exported = []
+        profiler = ScanProfile(exporter=exported.append)
+        it = mailtank.client.MailtankIterator(lambda n: PAGES_DATA[n],
+                                              profiler=profiler)
+
+        pages = it.iter_pages()
+        next(pages)
+        pages.close()
+
+        assert exported == [profiler]
+        assert profiler.summary()['objects'] == 10
+
+
+class TestTagCatalog(object):
+    def setup_method(self, method):
+        self.m = mailtank.Mailtank('http://api.mailtank.ru', 'pumpurum')
+
+    def register_tags(self, pages=PAGES_DATA):
+        requested_pages = []
+
+        def request_callback(method, uri, headers):
+            page = int(furl.furl(uri).args['page'])
+            requested_pages.append(page)
+            return (200, headers, json.dumps(pages[page - 1]))
+
+        httpretty.register_uri(
+            httpretty.GET, 'http://api.mailtank.ru/tags/',
+            body=request_callback)
+        return requested_pages
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline
+            time.sleep(0.01)
+
+    @httpretty.httprettified
+    def test_mask(self):
+        requested_pages = self.register_tags()
+        catalog = self.m.get_tag_catalog()
+
+        assert len(catalog) == sum(len(page['objects']) for page in PAGES_DATA)
+        assert catalog.get_tag_names(prefix='type_') == [
+            'type_main_news', 'type_spec', 'type_unknown']
+        assert catalog.get_tag_names(prefix='tag_22') == [
+            'tag_22078', 'tag_22437', 'tag_22622']
+        assert catalog.get_tag_names(prefix='tag_22', start=1, end=2) == ['tag_22437']
+        assert catalog.get_tag_names(prefix='nonexistent') == []
+        assert [tag.name for tag in catalog.get_tags(prefix='type_s')] == ['type_spec']
+        assert 'tag_7900' in catalog
+        # Список тегов загружается один раз
+        assert len(requested_pages) == 4
+
+    @httpretty.httprettified
+    def test_background_refresh(self):
+        pages = copy.deepcopy(PAGES_DATA)
+        fetching = threading.Event()
+        resume = threading.Event()
+        resume.set()
+
+        def request_callback(method, uri, headers):
+            fetching.set()
+            resume.wait(5)
+            page = int(furl.furl(uri).args['page'])
+            return (200, headers, json.dumps(pages[page - 1]))
+
+        httpretty.register_uri(
+            httpretty.GET, 'http://api.mailtank.ru/tags/',
+            body=request_callback)
+        httpretty.register_uri(
+            httpretty.POST, 'http://api.mailtank.ru/subscribers/',
+            body=json.dumps(SUBSCRIBERS_DATA[0]['objects'][0]))
+        m = mailtank.Mailtank('http://api.mailtank.ru', 'pumpurum',
+                              tag_catalog_ttl=0.5)
+        catalog = m.get_tag_catalog()
+        assert 'tag_new' not in catalog
+
+        pages[-1]['objects'].append({'name': 'tag_new'})
+        fetching.clear()
+        resume.clear()
+        time.sleep(0.6)
+
+        # Устаревший каталог отвечает старыми данными и обновляется в фоне
+        assert 'tag_new' not in catalog
+        assert fetching.wait(5)
+        m.create_subscriber('john@doe.com', tags=['rss:lala:1'])
+        resume.set()
+
+        self.wait_for(lambda: 'tag_new' in catalog)
+        assert 'rss:lala:1' in catalog
+
+    @httpretty.httprettified
+    def test_failed_refresh(self):
+        failed_requests = []
+
+        def request_callback(method, uri, headers):
+            if failed_requests or catalog_loaded:
+                failed_requests.append(uri)
+                return (500, headers, json.dumps({'message': 'Oops'}))
+            page = int(furl.furl(uri).args['page'])
+            return (200, headers, json.dumps(PAGES_DATA[page - 1]))
+
+        httpretty.register_uri(
+            httpretty.GET, 'http://api.mailtank.ru/tags/',
+            body=request_callback)
+        m = mailtank.Mailtank('http://api.mailtank.ru', 'pumpurum',
+                              tag_catalog_ttl=0.5)
+        catalog = m.get_tag_catalog()
+        catalog_loaded = False
+        tags_count = len(catalog)
+        catalog_loaded = True
+        time.sleep(0.6)
+
+        assert len(catalog) == tags_count
+        self.wait_for(lambda: failed_requests and not catalog._refreshing)
+        # До истечения `ttl` повторных попыток нет
+        for _ in range(5):
+            assert len(catalog) == tags_count
+            time.sleep(0.05)
+        assert len(failed_requests) == 1
+
+    @httpretty.httprettified
+    def test_implicitly_created_tags(self):
+        self.register_tags()
+        catalog = self.m.get_tag_catalog()
+        assert 'rss:lala:1' not in catalog
+
+        httpretty.register_uri(
+            httpretty.POST, 'http://api.mailtank.ru/subscribers/',
+            body=json.dumps(SUBSCRIBERS_DATA[0]['objects'][0]))
+        httpretty.register_uri(
+            httpretty.PATCH, 'http://api.mailtank.ru/subscribers/')
+
+        self.m.create_subscriber('john@doe.com', tags=['rss:lala:1'])
+        self.m.reassign_tag('rss:lala:2', ['id1'])
+
+        assert catalog.get_tag_names(prefix='rss:lala:') == ['rss:lala:1', 'rss:lala:2']
+
+
+class TestReconcile(object):
+    DESIRED = [{
+        'id': 'c9a454f096',
+        'email': 'anthony.romanovich@gmail.com',
+        'tags': ['rss:lala:http://lala.ru/lala:100', 'new'],
+    }, {
+        'id': 'abc',
+        'email': 'john@doe.com',
+        'tags': ['new'],
+    }]
+
+    def setup_method(self, method):
+        self.m = mailtank.Mailtank('http://api.mailtank.ru', 'pumpurum')
+
+    def register_subscribers(self):
+        def request_callback(method, uri, headers):
+            page = int(furl.furl(uri).args['page'])
+            return (200, headers, json.dumps(SUBSCRIBERS_DATA[page - 1]))
+
+        httpretty.register_uri(
+            httpretty.GET, 'http://api.mailtank.ru/subscribers/',
+            body=request_callback)
+
+    @httpretty.httprettified
+    def test_dry_run(self):
+        self.register_subscribers()
+
+        plan = self.m.reconcile_subscribers(self.DESIRED, dry_run=True)
+
+        assert [record['id'] for record in plan.creates] == ['abc']
+        assert plan.updates == [{
+            'id': 'c9a454f096',
+            'tags': ['new', 'rss:lala:http://lala.ru/lala:100'],
+        }]
+        assert plan.reassigns == []
+        assert plan.deletes == ['2eda62b980']
+        assert httpretty.last_request().method == 'GET'
+
+    @httpretty.httprettified
+    def test_reassign_tag(self):
+        self.register_subscribers()
+        requests = []
+
+        def request_callback(request, uri, headers):
+            body = json.loads(request.body) if request.body else None
+            requests.append((request.method, request.path, body))
+            return (200, headers, json.dumps({'id': 'abc'}))
+
+        httpretty.register_uri(
+            httpretty.POST, 'http://api.mailtank.ru/subscribers/',
+            body=request_callback)
+        httpretty.register_uri(
+            httpretty.PATCH, 'http://api.mailtank.ru/subscribers/',
+            body=request_callback)
+        httpretty.register_uri(
+            httpretty.DELETE, 'http://api.mailtank.ru/subscribers/2eda62b980',
+            body=request_callback)
+
+        plan = self.m.reconcile_subscribers(self.DESIRED, reassign_threshold=1)
+
+        assert plan.report() == {
+            'create': 1,
+            'update': 0,
+            'reassign_tag': 1,
+            'delete': 1,
+            'errors': 0,
+        }
+        assert [(method, path) for method, path, _ in requests] == [
+            ('DELETE', '/subscribers/2eda62b980'),
+            ('POST', '/subscribers/'),
+            ('PATCH', '/subscribers/'),
+        ]
+        assert requests[-1][2]['data'] == {
+            'tag': 'new',
+            'subscribers': ['c9a454f096', 'abc'],
+        }
+
+    @httpretty.httprettified
+    def test_desired_stream(self):
+        self.register_subscribers()
+        desired = (record for record in self.DESIRED)
+
+        plan = self.m.reconcile_subscribers(desired, dry_run=True,
+                                            reassign_threshold=1)
+
+        assert [record['id'] for record in plan.creates] == ['abc']
+        assert plan.reassigns == [('new', ['c9a454f096', 'abc'])]
+
+    def test_duplicate_ids(self):
+        with pytest.raises(ValueError):
+            self.m.reconcile_subscribers(self.DESIRED + self.DESIRED[-1:],
+                                         dry_run=True)
+
+
+class TestDiskCache(object):
+    def setup_method(self, method):
+        self.path = tempfile.mkdtemp()
+        httpretty.enable()
+
+    def teardown_method(self, method):
+        httpretty.disable()
+        httpretty.reset()
+        shutil.rmtree(self.path)
+
+    def register_unsubscribes(self):
+        requests = []
+
+        def request_callback(request, uri, headers):
+            requests.append(request)
+            if request.headers.get('If-None-Match') == '"v1"':
+                return (304, headers, '')
+            headers['ETag'] = '"v1"'
+            return (200, headers, json.dumps(UNSUBSCRIBES_DATA[0]))
+
+        httpretty.register_uri(
+            httpretty.GET, 'http://api.mailtank.ru/unsubscribed/',
+            body=request_callback)
+        return requests
+
+    def test_conditional_requests(self):
+        requests = self.register_unsubscribes()
+        m = mailtank.Mailtank('http://api.mailtank.ru', 'pumpurum',
+                              cache=DiskCache(self.path))
+
+        first = [u.to_dict() for u in m.get_unsubscribes()]
+        second = [u.to_dict() for u in m.get_unsubscribes()]
+
+        assert first == second
+        assert len(first) == 3
+        assert 'If-None-Match' not in requests[0].headers
+        assert requests[-1].headers['If-None-Match'] == '"v1"'
+
+    def test_total_count_from_cache(self):
+        requests = self.register_unsubscribes()
+        m = mailtank.Mailtank('http://api.mailtank.ru', 'pumpurum',
+                              cache=DiskCache(self.path, max_age=60))
+
+        assert m.get_unsubscribes().get_total_count() == 4
+        requests_made = len(requests)
+        assert m.get_unsubscribes().get_total_count() == 4
+        assert len(requests) == requests_made
+
+    def test_clients_sharing_cache(self):
+        requests = []
+
+        def request_callback(request, uri, headers):
+            requests.append(request)
+            total = {'a': 4, 'b': 7}[request.headers['X-Auth-Token']]
+            return (200, headers, json.dumps(dict(UNSUBSCRIBES_DATA[0],
+                                                  total=total)))
+
+        httpretty.register_uri(
+            httpretty.GET, 'http://api.mailtank.ru/unsubscribed/',
+            body=request_callback)
+        a = mailtank.Mailtank('http://api.mailtank.ru', 'a',
+                              cache=DiskCache(self.path))
+        b = mailtank.Mailtank('http://api.mailtank.ru', 'b',
+                              cache=DiskCache(self.path))
+
+        assert a.get_unsubscribes().get_total_count() == 4
+        assert b.get_unsubscribes().get_total_count() == 7
+        assert len(requests) == 2
+
+    def fill_cache(self, mtimes):
+        class Response(object):
+            headers = {}
+
+        cache = DiskCache(self.path)
+        for page, mtime in enumerate(mtimes, 1):
+            key = ['tags/', {'page': page}]
+            cache.set(key, {'objects': ['x' * 300]}, Response())
+            os.utime(cache._file_path(key), (mtime, mtime))
+
+        # Пятая страница не помещается вместе с остальными
+        cache.max_size = 1000
+        cache.set(['tags/', {'page': 5}], {'objects': ['x' * 300]},
+                  Response())
+        return [page for page in range(1, 6)
+                if cache.get(['tags/', {'page': page}]) is not None]
+
+    def test_eviction(self):
+        # Первая страница проверялась последней
+        assert self.fill_cache([400, 300, 200, 100]) == [1, 5]
+
+    def test_eviction_equal_mtimes(self):
+        assert self.fill_cache([100, 100, 100, 100]) == [4, 5]
+
 
 class TestMailtankClient(object):
     def setup_method(self, method):
@@ -158,6 +563,23 @@ class TestMailtankClient(object):
         assert tags[5].name == 'tag_11592'
         assert tags[-1].name == 'tag_23564'
 
+    @httpretty.httprettified
+    def test_get_tags_profiler(self):
+        def request_callback(method, uri, headers):
+            page = int(furl.furl(uri).args['page'])
+            return (200, headers, json.dumps(PAGES_DATA[page - 1]))
+
+        httpretty.register_uri(
+            httpretty.GET, 'http://api.mailtank.ru/tags/',
+            body=request_callback)
+
+        profiler = ScanProfile(exporter=None)
+        list(self.m.get_tags(profiler=profiler))
+
+        assert [stats.bytes_received for stats in profiler.pages] == [
+            len(json.dumps(PAGES_DATA[n])) for n in (0, 0, 1, 2)]
+        assert all(stats.decode_time is not None for stats in profiler.pages)
+
     @httpretty.httprettified
     def test_get_subscribers(self):
         def request_callback(method, uri, headers):